@@ -1,9 +1,18 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from bson import ObjectId
+import numpy as np
 import os
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 # Flask app
 app = Flask(__name__)
@@ -15,14 +24,34 @@ db = client["civic_ai"]
 reports_collection = db.get_collection("reports")
 users_collection = db.get_collection("users")
 
+# Unique email index for the login/register lookups; retried by register() until it exists
+email_index_ready = False
+
+def ensure_email_index():
+    global email_index_ready
+    if not email_index_ready:
+        try:
+            users_collection.create_index("email", unique=True)
+            email_index_ready = True
+        except PyMongoError as e:
+            logger.warning(f"Could not create unique users.email index (unreachable Mongo or duplicate emails?): {e}")
+    return email_index_ready
+
+# A failure must not stop the app
+ensure_email_index()
+
+# Random source for the dummy classifier
+_rng = np.random.default_rng()
+_SEV = np.array(["low", "medium", "high"])
+
 # Dummy AI classifier (replace with your model)
 def classify_issue(image_file, category):
     # Simulate AI prediction
-    from random import random, choice
+    p = _rng.random()
     return {
-        "is_match": random() > 0.2,
-        "probability": round(random(), 2),
-        "severity": choice(["low", "medium", "high"])
+        "is_match": bool(p > 0.2),
+        "probability": float(round(p, 2)),
+        "severity": str(_SEV[_rng.integers(3)])
     }
 
 # ---------- Routes ---------- #
@@ -62,6 +91,24 @@ def submit_report():
 
 # ---------- User Authentication ---------- #
 
+# Argon2id hashing; argon2-cffi releases the GIL while hashing so other request threads keep running
+password_hasher = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=2)
+
+# Check a password against the stored hash, upgrading legacy werkzeug PBKDF2 hashes to Argon2
+def verify_password(user, password):
+    stored_hash = user['password']
+    if stored_hash.startswith('$argon2'):
+        try:
+            password_hasher.verify(stored_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if not password_hasher.check_needs_rehash(stored_hash):
+            return True
+    elif not check_password_hash(stored_hash, password):
+        return False
+    users_collection.update_one({'_id': user['_id']}, {'$set': {'password': password_hasher.hash(password)}})
+    return True
+
 @app.route('/register', methods=['POST'])
 def register():
     data = request.json
@@ -73,17 +120,20 @@ def register():
     if not name or not email or not password:
         return jsonify({'error': 'Missing required fields'}), 400
 
-    if users_collection.find_one({'email': email}):
-        return jsonify({'error': 'User already exists'}), 409
-
-    hashed_password = generate_password_hash(password)
+    hashed_password = password_hasher.hash(password)
     user = {
         'name': name,
         'email': email,
         'neighborhood': neighborhood,
         'password': hashed_password
     }
-    result = users_collection.insert_one(user)
+    # The unique email index rejects duplicates; without it, fall back to an explicit lookup
+    if not ensure_email_index() and users_collection.find_one({'email': email}):
+        return jsonify({'error': 'User already exists'}), 409
+    try:
+        result = users_collection.insert_one(user)
+    except DuplicateKeyError:
+        return jsonify({'error': 'User already exists'}), 409
     return jsonify({'message': 'User registered', 'id': str(result.inserted_id)}), 201
 
 @app.route('/login', methods=['POST'])
@@ -93,7 +143,7 @@ def login():
     password = data.get('password')
 
     user = users_collection.find_one({'email': email})
-    if user and check_password_hash(user['password'], password):
+    if user and password and verify_password(user, password):
         return jsonify({
             'message': 'Login successful',
             'user': {
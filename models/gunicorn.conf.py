@@ -0,0 +1,16 @@
+import os
+
+# Gunicorn settings for the model server; run from this directory with: gunicorn -c gunicorn.conf.py wsgi:app
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+# The first boot quantizes and compiles the backbone inside the worker, which can take a while
+timeout = 120
+
+# Load the models in each worker before it accepts requests, splitting the cores between workers
+def post_worker_init(worker):
+    import torch
+    from model import init_inference
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // worker.cfg.workers))
+    init_inference()
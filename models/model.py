@@ -2,15 +2,35 @@ from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import os
 import cv2
+import numpy as np
 import torch
 import torch.nn as nn
-from torchvision import models, transforms
+from torchvision import models
 from torchvision.models import MobileNet_V2_Weights
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from safetensors import safe_open
 from dotenv import load_dotenv
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
 from bson import json_util
 import json
 import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows only runs the single-process dev server, so no cross-process lock is needed
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -27,47 +47,368 @@ MONGO_URI = os.getenv("MONGO_URI")  # MongoDB Atlas URI from .env
 client = MongoClient(MONGO_URI)
 db = client.get_database('civic')  # Access default database
 issues_collection = db.get_collection("issues")
+issues_index_ready = False
+
+# Create the issues index on first use by a Mongo route, so a down database never delays /predict startup
+def ensure_issues_index():
+    global issues_index_ready
+    if not issues_index_ready:
+        try:
+            issues_collection.create_index([("type", 1), ("location.latitude", 1), ("location.longitude", 1)])
+            issues_index_ready = True
+        except PyMongoError as e:
+            logger.warning(f"Could not create issues index: {e}")
 
 # Define model categories
 categories = ["drainage", "pothole", "garbage_waste"]
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-# Create the binary model for each category
-def create_binary_model():
-    model = models.mobilenet_v2(weights=MobileNet_V2_Weights.IMAGENET1K_V1)
-    for param in model.features.parameters():
-        param.requires_grad = False
-    for param in model.features[-2:].parameters():
-        param.requires_grad = True
-    model.classifier = nn.Sequential(
+
+# Backbone runtime: "torchscript" (default) or "onnx" to serve it through ONNX Runtime
+inference_backend = os.getenv("INFERENCE_BACKEND", "torchscript")
+if inference_backend == "onnx" and ort is None:
+    logger.warning("INFERENCE_BACKEND=onnx but onnxruntime is not installed; falling back to TorchScript")
+    inference_backend = "torchscript"
+
+# With ONNX Runtime the torch side (normalization, heads) stays on the CPU; ORT picks its own provider
+device = torch.device("cuda" if torch.cuda.is_available() and inference_backend != "onnx" else "cpu")
+# Serve in FP16 on CUDA; the CPU path uses the INT8 backbone with FP32 inputs
+model_dtype = torch.float16 if device.type == "cuda" else torch.float32
+
+# Shared frozen MobileNetV2 feature extractor producing a 1280-dim embedding
+def create_backbone():
+    features = models.mobilenet_v2(weights=MobileNet_V2_Weights.IMAGENET1K_V1).features
+    backbone = nn.Sequential(features, nn.AdaptiveAvgPool2d(1), nn.Flatten(1))
+    # channels_last matches the NHWC layout oneDNN and cuDNN prefer for depthwise convs
+    return backbone.to(device, model_dtype, memory_format=torch.channels_last).eval()
+
+# Binary classifier head for each category, applied to the shared embedding
+def create_head():
+    head = nn.Sequential(
         nn.Linear(1280, 512),
         nn.ReLU(),
         nn.Dropout(0.4),
         nn.Linear(512, 2)
     )
-    return model.to(device)
+    return head.to(device, model_dtype).eval()
+
+# Find a category checkpoint, preferring safetensors over older .pth files
+def find_checkpoint(category):
+    for extension in ("safetensors", "pth"):
+        model_path = os.path.join(base_dir, f"{category}_model.{extension}")
+        if os.path.exists(model_path):
+            return model_path
+    return None
+
+# The trainer used to fine-tune the last two feature blocks; such checkpoints don't fit the shared ImageNet backbone
+tuned_feature_prefixes = ("features.17.", "features.18.")
+
+# Read the checkpoint tensors whose names start with one of the prefixes, on the CPU
+def load_checkpoint_tensors(model_path, prefixes):
+    if model_path.endswith(".safetensors"):
+        # safe_open memory-maps the file and only reads the requested tensors
+        with safe_open(model_path, framework="pt", device="cpu") as checkpoint:
+            return {key: checkpoint.get_tensor(key) for key in checkpoint.keys() if key.startswith(prefixes)}
+    state_dict = torch.load(model_path, map_location="cpu")
+    return {key: value for key, value in state_dict.items() if key.startswith(prefixes)}
+
+# ImageNet weights of the feature blocks a legacy checkpoint may have fine-tuned
+def load_reference_features():
+    features = models.mobilenet_v2(weights=MobileNet_V2_Weights.IMAGENET1K_V1).features
+    reference = {f"features.{key}": value for key, value in features.state_dict().items()}
+    return {key: value for key, value in reference.items() if key.startswith(tuned_feature_prefixes)}
+
+# Load a category head, refusing checkpoints trained on top of a fine-tuned backbone
+def load_head(category, model_path, reference_features):
+    checkpoint = load_checkpoint_tensors(model_path, ("classifier.",) + tuned_feature_prefixes)
+    for key, value in reference_features.items():
+        if key not in checkpoint or not torch.equal(checkpoint[key], value):
+            logger.error(f"Skipping {model_path}: its feature blocks differ from the shared ImageNet backbone. "
+                         f"Retrain the {category} model with train_test.py.")
+            return None
+    prefix = "classifier."
+    head = create_head()
+    head.load_state_dict({key[len(prefix):]: value for key, value in checkpoint.items() if key.startswith(prefix)})
+    return head
 
-# Initialize category models
-category_models = {}
+# Image preprocessing: ImageNet normalization folded into one subtract and multiply on 0-255 pixels
+input_size = (224, 224)
+pixel_mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1) * 255
+pixel_inv_std = 1 / torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1) / 255
+
+# Resize an RGB uint8 array on the CPU; conversion to float happens after the upload
+def preprocess(img):
+    img = cv2.resize(img, input_size, interpolation=cv2.INTER_AREA)
+    return torch.from_numpy(img)
+
+# Move a uint8 NHWC batch to the device and normalize it there; the permute yields channels_last
+def normalize(batch, out=None):
+    batch = batch.to(device, non_blocking=True).permute(0, 3, 1, 2)
+    out = batch.to(model_dtype) if out is None else out.copy_(batch)
+    return out.sub_(pixel_mean).mul_(pixel_inv_std)
+
+# INT8 quantization settings (CPU only): fbgemm on x86 servers, qnnpack on ARM
+quantized_engine = "fbgemm" if "fbgemm" in torch.backends.quantized.supported_engines else "qnnpack"
+num_calibration_images = 100
 base_dir = os.path.dirname(os.path.abspath(__file__))
-for category in categories:
-    model = create_binary_model()
-    model_path = os.path.join(base_dir, f"{category}_model.pth")
-    if os.path.exists(model_path):
-        model.load_state_dict(torch.load(model_path, map_location=device))
-        model.to(device)
-        category_models[category] = model
-        logger.info(f"Loaded model for {category} from {model_path}")
-    else:
-        logger.error(f"Warning: Model file {model_path} not found. Ensure models are trained and available.")
+calibration_dir = os.path.join(base_dir, "processed_dataset", "train")
+
+# Load a balanced sample of training images to calibrate the quantized activations
+def load_calibration_images():
+    images = []
+    per_category = num_calibration_images // len(categories)
+    for category in categories:
+        category_dir = os.path.join(calibration_dir, category)
+        if not os.path.isdir(category_dir):
+            continue
+        for filename in sorted(os.listdir(category_dir))[:per_category]:
+            img = cv2.imread(os.path.join(category_dir, filename))
+            if img is None:
+                continue
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            images.append(normalize(preprocess(img).unsqueeze(0)))
+    return images
+
+# Post-training static quantization of a FP32 model via FX graph mode
+def quantize_model(model, calibration_images):
+    torch.backends.quantized.engine = quantized_engine
+    model = model.cpu().eval()
+    example_inputs = (torch.randn(1, 3, 224, 224).contiguous(memory_format=torch.channels_last),)
+    # prepare_fx fuses Conv-BN-ReLU itself, so no explicit fuse_modules pass is needed
+    prepared = prepare_fx(model, get_default_qconfig_mapping(quantized_engine), example_inputs)
+    with torch.no_grad():
+        for img_tensor in calibration_images:
+            prepared(img_tensor)
+    return convert_fx(prepared)
+
+# Trace, freeze and optimize a model so requests skip the eager Python dispatcher
+def script_model(model):
+    model.eval()
+    with torch.no_grad():
+        example_input = torch.randn(1, 3, 224, 224).to(device, model_dtype, memory_format=torch.channels_last)
+        scripted = torch.jit.trace(model, example_input)
+        scripted = torch.jit.freeze(scripted)
+        return torch.jit.optimize_for_inference(scripted)
+
+# The cache name records how the backbone was built, so a different engine, precision or torch rebuilds it
+def backbone_cache_path():
+    precision = f"int8-{quantized_engine}" if device.type == "cpu" else "fp16"
+    return os.path.join(base_dir, f"backbone.{device.type}-{precision}.torch-{torch.__version__}.ts")
+
+# Serialize artifact builds across gunicorn workers: the first one builds, the others wait and load its output
+@contextmanager
+def artifact_lock(path):
+    with open(f"{path}.lock", "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+# Write to a temp file and rename it into place so no reader ever sees a partial artifact
+def save_atomically(save, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save(tmp_path)
+    os.replace(tmp_path, path)
+
+# Load the cached TorchScript backbone, otherwise quantize (CPU only) and compile it
+def compile_backbone(backbone):
+    scripted_path = backbone_cache_path()
+    with artifact_lock(scripted_path):
+        if os.path.exists(scripted_path):
+            logger.info(f"Loaded TorchScript backbone from {scripted_path}")
+            return torch.jit.load(scripted_path, map_location=device)
+        # Quantized kernels are CPU only; keep FP16 on CUDA
+        if device.type == "cpu":
+            calibration_images = load_calibration_images()
+            if not calibration_images:
+                # Not cached, so INT8 is built once calibration images are available
+                logger.warning(f"No calibration images found in {calibration_dir}; serving FP32 backbone")
+                return script_model(backbone)
+            backbone = quantize_model(backbone, calibration_images)
+            logger.info("Quantized backbone to INT8")
+        scripted = script_model(backbone)
+        save_atomically(lambda path: torch.jit.save(scripted, path), scripted_path)
+        logger.info(f"Compiled TorchScript backbone and saved it to {scripted_path}")
+        return scripted
 
-# Image preprocessing transform
-transform = transforms.Compose([
-    transforms.ToPILImage(),
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-])
+# Wraps an ONNX Runtime session so it can be called like the TorchScript backbone
+class OnnxBackbone:
+    def __init__(self, session):
+        self.session = session
+
+    def __call__(self, inputs):
+        embeddings = self.session.run(None, {"x": inputs.contiguous().numpy()})[0]
+        return torch.from_numpy(embeddings)
+
+# Export the FP32 backbone to ONNX once and load it with all graph optimizations enabled
+def load_onnx_backbone(backbone):
+    onnx_path = os.path.join(base_dir, "backbone.onnx")
+
+    def export(path):
+        with torch.no_grad():
+            torch.onnx.export(backbone, torch.randn(1, 3, 224, 224), path,
+                              input_names=["x"], output_names=["embedding"],
+                              dynamic_axes={"x": {0: "N"}, "embedding": {0: "N"}}, opset_version=17)
+
+    with artifact_lock(onnx_path):
+        if not os.path.exists(onnx_path):
+            save_atomically(export, onnx_path)
+            logger.info(f"Exported ONNX backbone to {onnx_path}")
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    # Match torch's per-worker thread budget (set by gunicorn.conf.py) instead of one thread per core
+    sess_options.intra_op_num_threads = torch.get_num_threads()
+    available = ort.get_available_providers()
+    providers = [provider for provider in ("CUDAExecutionProvider", "CPUExecutionProvider") if provider in available]
+    session = ort.InferenceSession(onnx_path, sess_options, providers=providers)
+    logger.info(f"Loaded ONNX backbone from {onnx_path} with providers {session.get_providers()}")
+    return OnnxBackbone(session)
+
+# Micro-batching settings for /predict
+max_batch_size = 16
+max_batch_wait = 0.01  # seconds to wait for more requests before running a batch
+prediction_timeout = 30  # seconds
+
+# A match needs probability >= 0.7; severity is low below 0.8, medium below 0.9, high otherwise
+match_threshold = 0.7
+severity_bins = np.array([0.8, 0.9])
+severity_labels = np.array(["low", "medium", "high"])
+
+# Collects concurrent /predict requests and runs them through the backbone in one forward pass
+class InferenceBatcher:
+    def __init__(self, backbone, heads, max_batch_size, max_wait):
+        self.backbone = backbone
+        self.heads = heads
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        # Input buffers reused for every batch; only the batcher thread touches them
+        height, width = input_size[1], input_size[0]
+        self.staging = torch.empty((max_batch_size, height, width, 3), dtype=torch.uint8,
+                                   pin_memory=device.type == "cuda")
+        self.device_staging = torch.empty_like(self.staging, device=device) if device.type == "cuda" else self.staging
+        self.inputs = torch.empty((max_batch_size, 3, height, width), dtype=model_dtype, device=device,
+                                  memory_format=torch.channels_last)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, category, img_tensor):
+        future = Future()
+        self.queue.put((category, img_tensor, future))
+        return future
+
+    # Run dummy batches through the full path so kernel selection and JIT profiling happen before traffic
+    def warmup(self, iterations=5):
+        # cuDNN autotunes per input shape, so cover every batch size the batcher can produce
+        sizes = range(1, self.max_batch_size + 1) if device.type == "cuda" else (1, self.max_batch_size)
+        with torch.inference_mode():
+            for size in sizes:
+                inputs = normalize(self.device_staging[:size], self.inputs[:size])
+                for _ in range(iterations):
+                    embeddings = self.backbone(inputs)
+                    for head in self.heads.values():
+                        head(embeddings)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+    # Futures cancelled by timed-out handlers are dropped here; the rest are marked running
+    def _collect(self):
+        batch = []
+        deadline = None
+        while len(batch) < self.max_batch_size:
+            if deadline is None:
+                item = self.queue.get()
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if not item[2].set_running_or_notify_cancel():
+                continue
+            batch.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + self.max_wait
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            futures = [future for _, _, future in batch]
+            buckets = {}
+            for index, (category, _, _) in enumerate(batch):
+                buckets.setdefault(category, []).append(index)
+            try:
+                size = len(batch)
+                for index, (_, img_tensor, _) in enumerate(batch):
+                    self.staging[index].copy_(img_tensor)
+                if self.device_staging is not self.staging:
+                    self.device_staging[:size].copy_(self.staging[:size], non_blocking=True)
+                inputs = normalize(self.device_staging[:size], self.inputs[:size])
+                with torch.inference_mode():
+                    embeddings = self.backbone(inputs)
+                    for category, indices in buckets.items():
+                        outputs = self.heads[category](embeddings[indices])
+                        probabilities = torch.softmax(outputs.float(), dim=1)[:, 1].cpu().numpy()
+                        matches = probabilities >= match_threshold
+                        severities = severity_labels[np.searchsorted(severity_bins, probabilities, side="right")]
+                        for index, probability, is_match, severity in zip(
+                                indices, probabilities.tolist(), matches.tolist(), severities.tolist()):
+                            result = {'is_match': is_match, 'probability': probability}
+                            if is_match:
+                                result['severity'] = severity
+                            futures[index].set_result(result)
+            except Exception as e:
+                logger.error(f"Batched inference error: {e}")
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+
+# Inference state, built lazily by init_inference() so each gunicorn worker owns its torch context
+category_heads = {}
+backbone = None
+batcher = None
+init_lock = threading.Lock()
+
+# Load the shared backbone and category heads and start the batcher (once per process)
+def init_inference():
+    global backbone, batcher, pixel_mean, pixel_inv_std
+    with init_lock:
+        if batcher is not None:
+            return
+        pixel_mean = pixel_mean.to(device, model_dtype)
+        pixel_inv_std = pixel_inv_std.to(device, model_dtype)
+        if inference_backend == "onnx":
+            backbone = load_onnx_backbone(create_backbone())
+        else:
+            if device.type == "cpu":
+                torch.backends.quantized.engine = quantized_engine
+            backbone = compile_backbone(create_backbone())
+        reference_features = load_reference_features()
+        for category in categories:
+            model_path = find_checkpoint(category)
+            if not model_path:
+                logger.error(f"Warning: No model file for {category} found in {base_dir}. Ensure models are trained and available.")
+                continue
+            head = load_head(category, model_path, reference_features)
+            if head is not None:
+                category_heads[category] = head
+                logger.info(f"Loaded head for {category} from {model_path}")
+        # Input shape is fixed, so letting cuDNN benchmark conv algorithms is a pure win
+        if device.type == "cuda":
+            torch.backends.cudnn.benchmark = True
+        ready_batcher = InferenceBatcher(backbone, category_heads, max_batch_size, max_batch_wait)
+        ready_batcher.warmup()
+        logger.info("Warmed up the backbone and heads")
+        # Publish only after warmup so no request shares the buffers with it
+        batcher = ready_batcher
+
+# Decode an uploaded image straight from the request stream into an RGB array
+def decode_image(image_file):
+    buf = np.frombuffer(image_file.read(), dtype=np.uint8)
+    img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Failed to load image")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
 @app.route('/')
 def home():
@@ -84,38 +425,24 @@ def predict():
         if category not in categories:
             return jsonify({'error': 'Invalid category'}), 400
 
-        upload_dir = os.path.join(base_dir, 'uploads')
-        os.makedirs(upload_dir, exist_ok=True)
-        image_path = os.path.join(upload_dir, image_file.filename)
-        image_file.save(image_path)
-        logger.info(f"Saved image to {image_path}")
-
-        # Read and preprocess
-        img = cv2.imread(image_path)
-        if img is None:
-            raise ValueError("Failed to load image")
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img_tensor = transform(img).unsqueeze(0).to(device)
-
-        model = category_models.get(category)
-        if not model:
+        # Servers without a post-fork hook load the models on the first request
+        if batcher is None:
+            init_inference()
+
+        # Decode in memory and preprocess
+        img = decode_image(image_file)
+        img_tensor = preprocess(img)
+
+        if category not in category_heads:
             raise ValueError(f"Model for {category} not loaded")
 
-        model.eval()
-        with torch.no_grad():
-            outputs = model(img_tensor)
-            probs = torch.softmax(outputs, dim=1)
-            probability = probs[0][1].item()
-            is_match = probability >= 0.7
-
-            result = {'is_match': is_match, 'probability': probability}
-            if is_match:
-                if probability >= 0.9:
-                    result['severity'] = 'high'
-                elif probability >= 0.8:
-                    result['severity'] = 'medium'
-                else:
-                    result['severity'] = 'low'
+        # Queue for the batcher and wait for this image's result
+        future = batcher.submit(category, img_tensor)
+        try:
+            result = future.result(timeout=prediction_timeout)
+        finally:
+            # No-op once the batcher has picked it up; drops it from the queue if we timed out
+            future.cancel()
 
         return jsonify(result)
 
@@ -123,11 +450,6 @@ def predict():
         logger.error(f"Prediction error: {e}")
         return jsonify({'error': str(e)}), 500
 
-    finally:
-        if os.path.exists(image_path):
-            os.remove(image_path)
-            logger.info(f"Removed temporary file {image_path}")
-
 @app.route('/reports', methods=['POST'])
 def submit_report():
     try:
@@ -151,13 +473,6 @@ def submit_report():
         if not issue_type or not latitude or not longitude:
             return jsonify({'error': 'Type, latitude, and longitude are required'}), 400
 
-        # Save the image
-        upload_dir = os.path.join(base_dir, 'uploads')
-        os.makedirs(upload_dir, exist_ok=True)
-        image_path = os.path.join(upload_dir, image_file.filename)
-        image_file.save(image_path)
-        logger.info(f"Saved image to {image_path}")
-
         # Prepare report data with location as a dictionary and image filename
         report_data = {
             'type': issue_type,
@@ -169,32 +484,47 @@ def submit_report():
         }
 
         # Insert into MongoDB
+        ensure_issues_index()
         result = issues_collection.insert_one(report_data)
 
         return jsonify({"message": "Report submitted successfully", "id": str(result.inserted_id)}), 200
     except Exception as e:
         logger.error(f"Error submitting report: {e}")
-        if os.path.exists(image_path):
-            os.remove(image_path)
-            logger.info(f"Removed temporary file {image_path}")
         return jsonify({'error': str(e)}), 500
-    finally:
-        if os.path.exists(image_path):
-            os.remove(image_path)
-            logger.info(f"Removed temporary file {image_path}")
 
 @app.route('/complaints', methods=['GET'])
 def complaints():
     try:
-        complaints = list(issues_collection.find())
-        complaints_json = json_util.dumps(complaints)
-        return Response(complaints_json, mimetype='application/json'), 200
+        ensure_issues_index()
+        cursor = issues_collection.find().batch_size(500)
+        # Run the query now so connection errors still produce the 500 below
+        first = next(cursor, None)
+
+        # Stream the JSON array one document at a time instead of building it in memory
+        def generate():
+            try:
+                yield '['
+                if first is not None:
+                    yield json_util.dumps(first)
+                    for complaint in cursor:
+                        yield ',' + json_util.dumps(complaint)
+                yield ']'
+            except Exception as e:
+                # The 200 is already sent; abort the stream rather than end with a truncated but valid array
+                logger.error(f"Error streaming complaints: {e}")
+                raise
+
+        response = Response(generate(), mimetype='application/json')
+        # Runs even if the server closes the response before iterating it (e.g. client disconnect)
+        response.call_on_close(cursor.close)
+        return response, 200
     except Exception as e:
         logger.error(f"Error fetching complaints: {e}")
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
-    if not category_models:
+    init_inference()
+    if not category_heads:
         logger.error("No models loaded. Please ensure model files are present.")
     else:
         logger.info("All models loaded successfully. Starting server...")
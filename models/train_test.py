@@ -6,9 +6,9 @@ import torch.optim as optim
 from torch.utils.data import DataLoader, Dataset
 from torchvision import datasets, models, transforms
 from torchvision.models import MobileNet_V2_Weights
-from torch.utils.data.sampler import WeightedRandomSampler
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from PIL import Image
+from safetensors.torch import save_file, load_file
 import numpy as np
 
 # Define paths and parameters
@@ -16,8 +16,10 @@ processed_dataset_path = "C:\\Users\\Admin\\Documents\\Project civic\\Civic\\pro
 categories = ["drainage", "pothole", "garbage_waste"]
 batch_size = 8
 num_epochs = 20
+num_workers = max(1, (os.cpu_count() or 2) // 2)
 target_size = (224, 224)
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+use_amp = device.type == "cuda"  # mixed precision only on GPU
 
 # Create necessary directories if they don't exist
 for split in ['train', 'val']:
@@ -56,13 +58,11 @@ class BinaryDataset(Dataset):
         binary_label = 1 if label == self.target_class_idx else 0
         return img, binary_label
 
-# Create model
+# Create model; the feature extractor stays frozen so the server can share one backbone across categories
 def create_binary_model():
     model = models.mobilenet_v2(weights=MobileNet_V2_Weights.IMAGENET1K_V1)
     for param in model.features.parameters():
         param.requires_grad = False
-    for param in model.features[-2:].parameters():
-        param.requires_grad = True
     model.classifier = nn.Sequential(
         nn.Linear(1280, 512),
         nn.ReLU(),
@@ -74,8 +74,9 @@ def create_binary_model():
 # Training function
 def train_model(model, train_loader, val_loader, category):
     criterion = nn.CrossEntropyLoss()
-    optimizer = optim.Adam(model.parameters(), lr=0.001, weight_decay=1e-4)
+    optimizer = optim.Adam(model.classifier.parameters(), lr=0.001, weight_decay=1e-4)
     scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.5, patience=2, min_lr=1e-6)
+    scaler = torch.amp.GradScaler("cuda", enabled=use_amp)
 
     best_val_loss = float("inf")
     patience = 5
@@ -83,14 +84,17 @@ def train_model(model, train_loader, val_loader, category):
 
     for epoch in range(num_epochs):
         model.train()
+        model.features.eval()  # keep the shared backbone's batch-norm statistics fixed
         running_loss, running_corrects = 0.0, 0
         for inputs, labels in train_loader:
-            inputs, labels = inputs.to(device), labels.to(device)
+            inputs, labels = inputs.to(device, non_blocking=True), labels.to(device, non_blocking=True)
             optimizer.zero_grad()
-            outputs = model(inputs)
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
+            with torch.autocast(device_type=device.type, dtype=torch.float16, enabled=use_amp):
+                outputs = model(inputs)
+                loss = criterion(outputs, labels)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             running_loss += loss.item() * inputs.size(0)
             preds = torch.max(outputs, 1)[1]
             running_corrects += torch.sum(preds == labels.data)
@@ -100,9 +104,9 @@ def train_model(model, train_loader, val_loader, category):
 
         model.eval()
         val_loss, val_corrects = 0.0, 0
-        with torch.no_grad():
+        with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.float16, enabled=use_amp):
             for inputs, labels in val_loader:
-                inputs, labels = inputs.to(device), labels.to(device)
+                inputs, labels = inputs.to(device, non_blocking=True), labels.to(device, non_blocking=True)
                 outputs = model(inputs)
                 loss = criterion(outputs, labels)
                 val_loss += loss.item() * inputs.size(0)
@@ -120,7 +124,7 @@ def train_model(model, train_loader, val_loader, category):
         if val_loss < best_val_loss:
             best_val_loss = val_loss
             patience_counter = 0
-            torch.save(model.state_dict(), f"{category}_model.pth")
+            save_file(model.state_dict(), f"{category}_model.safetensors")
         else:
             patience_counter += 1
             if patience_counter >= patience:
@@ -159,65 +163,73 @@ def predict_image(model, image_path, category):
     except Exception as e:
         raise e
 
-# Train models
-for category in categories:
-    print(f"\nTraining model for {category}")
-    train_dataset = datasets.ImageFolder(os.path.join(processed_dataset_path, "train"), transform=train_transforms)
-    val_dataset = datasets.ImageFolder(os.path.join(processed_dataset_path, "val"), transform=val_transforms)
-    class_to_idx = train_dataset.class_to_idx
-    target_class_idx = class_to_idx[category]
-
-    binary_train_dataset = BinaryDataset(train_dataset, target_class_idx)
-    binary_val_dataset = BinaryDataset(val_dataset, target_class_idx)
-
-    train_loader = DataLoader(binary_train_dataset, batch_size=batch_size, sampler=WeightedRandomSampler(
-        [1.0] * len(binary_train_dataset), len(binary_train_dataset), replacement=True), num_workers=0)
-    val_loader = DataLoader(binary_val_dataset, batch_size=batch_size, shuffle=False, num_workers=0)
-
-    model = create_binary_model()
-    train_model(model, train_loader, val_loader, category)
-
-# Inference loop
-print("\nTraining complete. Now starting inference.")
-print("Welcome to the image classification system.")
-print("Upload an image and select a category to check if the image belongs to that category.")
-print("Enter 'quit' at any time to exit.")
-
-while True:
-    image_path = input("\nEnter image path (or 'quit' to exit): ")
-    if image_path.lower() == "quit":
-        break
-    if not os.path.exists(image_path):
-        print("Invalid image path! Please try again.")
-        continue
-
-    print("\nSelect category:")
-    for i, cat in enumerate(categories, 1):
-        print(f"{i}. {cat.capitalize()}")
-    while True:
-        category_num = input("Enter number (1-3): ")
-        try:
-            category_index = int(category_num) - 1
-            if 0 <= category_index < len(categories):
-                category = categories[category_index]
-                break
-            else:
-                print("Invalid number. Please enter 1, 2, or 3.")
-        except ValueError:
-            print("Invalid input. Please enter a number.")
+if __name__ == "__main__":
+    # Train models
+    for category in categories:
+        print(f"\nTraining model for {category}")
+        train_dataset = datasets.ImageFolder(os.path.join(processed_dataset_path, "train"), transform=train_transforms)
+        val_dataset = datasets.ImageFolder(os.path.join(processed_dataset_path, "val"), transform=val_transforms)
+        class_to_idx = train_dataset.class_to_idx
+        target_class_idx = class_to_idx[category]
 
-    model_path = f"{category}_model.pth"
-    if not os.path.exists(model_path):
-        print(f"Model for {category} not found! Please ensure the model is trained.")
-        continue
+        binary_train_dataset = BinaryDataset(train_dataset, target_class_idx)
+        binary_val_dataset = BinaryDataset(val_dataset, target_class_idx)
+
+        train_loader = DataLoader(binary_train_dataset, batch_size=batch_size, shuffle=True,
+            num_workers=num_workers, pin_memory=torch.cuda.is_available(), persistent_workers=True, prefetch_factor=4)
+        val_loader = DataLoader(binary_val_dataset, batch_size=batch_size, shuffle=False,
+            num_workers=num_workers, pin_memory=torch.cuda.is_available(), persistent_workers=True, prefetch_factor=4)
 
-    try:
         model = create_binary_model()
-        model.load_state_dict(torch.load(model_path))
-        model.to(device)
-        result = predict_image(model, image_path, category)
-        print(result)
-    except Exception as e:
-        print(f"Error during inference: {e}")
+        train_model(model, train_loader, val_loader, category)
+
+    # Inference loop
+    print("\nTraining complete. Now starting inference.")
+    print("Welcome to the image classification system.")
+    print("Upload an image and select a category to check if the image belongs to that category.")
+    print("Enter 'quit' at any time to exit.")
+
+    while True:
+        image_path = input("\nEnter image path (or 'quit' to exit): ")
+        if image_path.lower() == "quit":
+            break
+        if not os.path.exists(image_path):
+            print("Invalid image path! Please try again.")
+            continue
+
+        print("\nSelect category:")
+        for i, cat in enumerate(categories, 1):
+            print(f"{i}. {cat.capitalize()}")
+        while True:
+            category_num = input("Enter number (1-3): ")
+            try:
+                category_index = int(category_num) - 1
+                if 0 <= category_index < len(categories):
+                    category = categories[category_index]
+                    break
+                else:
+                    print("Invalid number. Please enter 1, 2, or 3.")
+            except ValueError:
+                print("Invalid input. Please enter a number.")
+
+        # Prefer safetensors checkpoints, falling back to older .pth files
+        model_path = f"{category}_model.safetensors"
+        if not os.path.exists(model_path):
+            model_path = f"{category}_model.pth"
+        if not os.path.exists(model_path):
+            print(f"Model for {category} not found! Please ensure the model is trained.")
+            continue
 
-print("Thank you for using the image classification system!")
+        try:
+            model = create_binary_model()
+            if model_path.endswith(".safetensors"):
+                model.load_state_dict(load_file(model_path, device=str(device)))
+            else:
+                model.load_state_dict(torch.load(model_path, map_location=device))
+            model.to(device)
+            result = predict_image(model, image_path, category)
+            print(result)
+        except Exception as e:
+            print(f"Error during inference: {e}")
+
+    print("Thank you for using the image classification system!")
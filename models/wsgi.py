@@ -0,0 +1,2 @@
+# WSGI entry point for production servers, e.g. gunicorn -c gunicorn.conf.py wsgi:app
+from model import app